@@ -0,0 +1,185 @@
+/* _score.c
+ *
+ * Compiled homology scoring kernel for evolve_strings.py.
+ * Build in place with: python setup.py build_ext --inplace
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+#define MAX_LENGTH 64 /* one bit per base in a uint64_t mask */
+#define MAX_OFFSETS (2*MAX_LENGTH - 1)
+#define PADDING MAX_LENGTH /* room either side of the second string for any offset */
+
+#if (defined(__GNUC__) || defined(__clang__)) && (defined(__x86_64__) || defined(__i386__))
+#include <immintrin.h>
+#define HAVE_AVX2 1
+static int use_avx2 = 0; /* set at import if the CPU supports AVX2 */
+#endif
+
+static int
+popcount64(uint64_t mask)
+{
+#if defined(__GNUC__) || defined(__clang__)
+    return __builtin_popcountll(mask);
+#else
+    int count = 0;
+    for (; mask; mask &= mask - 1)
+        count++;
+    return count;
+#endif
+}
+
+/* Same as get_sliding_window in evolve_strings.py for a substring of length k. */
+static Py_ssize_t
+sliding_window(Py_ssize_t k)
+{
+    return k > 1 ? k/2 - 1 : 0;
+}
+
+/*
+ * Get masks of matching bases for every offset in [-widest, widest].
+ * Bit i of matches[offset + widest] is set where base i of the first string
+ * equals base i + offset of the second.  Padding bytes never compare equal.
+ */
+static void
+base_matches(const unsigned char *padded_1, const unsigned char *padded_2, Py_ssize_t widest, uint64_t *matches)
+{
+    Py_ssize_t offset, i;
+
+    for (offset = -widest; offset <= widest; offset++) {
+        const unsigned char *shifted_2 = padded_2 + PADDING + offset;
+        uint64_t mask = 0;
+        for (i = 0; i < MAX_LENGTH; i++)
+            mask |= (uint64_t)(padded_1[i] == shifted_2[i]) << i;
+        matches[offset + widest] = mask;
+    }
+}
+
+#ifdef HAVE_AVX2
+/* Same as base_matches, comparing 32 bases per instruction. */
+__attribute__((target("avx2")))
+static void
+base_matches_avx2(const unsigned char *padded_1, const unsigned char *padded_2, Py_ssize_t widest, uint64_t *matches)
+{
+    __m256i low_1 = _mm256_loadu_si256((const __m256i *)padded_1);
+    __m256i high_1 = _mm256_loadu_si256((const __m256i *)(padded_1 + 32));
+    Py_ssize_t offset;
+
+    for (offset = -widest; offset <= widest; offset++) {
+        const unsigned char *shifted_2 = padded_2 + PADDING + offset;
+        __m256i low_2 = _mm256_loadu_si256((const __m256i *)shifted_2);
+        __m256i high_2 = _mm256_loadu_si256((const __m256i *)(shifted_2 + 32));
+        uint32_t low = (uint32_t)_mm256_movemask_epi8(_mm256_cmpeq_epi8(low_1, low_2));
+        uint32_t high = (uint32_t)_mm256_movemask_epi8(_mm256_cmpeq_epi8(high_1, high_2));
+        matches[offset + widest] = (uint64_t)high << 32 | low;
+    }
+}
+#endif
+
+/*
+ * Sum homology scores over substring lengths k in [1, length).
+ * runs[t] has bit i set where a run of k matching bases starts at position i
+ * of the first string and position i + offsets[t] of the second.
+ */
+static long
+score_runs(const unsigned char *codes_1, const unsigned char *codes_2, Py_ssize_t length)
+{
+    unsigned char padded_1[MAX_LENGTH], padded_2[MAX_LENGTH + 2*PADDING];
+    uint64_t matches[MAX_OFFSETS], runs[MAX_OFFSETS];
+    Py_ssize_t offsets[MAX_OFFSETS];
+    Py_ssize_t live = 0, widest, offset, t, k;
+    long score = 0;
+
+    memset(padded_1, 0xFE, sizeof(padded_1)); /* distinct padding so it never matches */
+    memset(padded_2, 0xFF, sizeof(padded_2));
+    memcpy(padded_1, codes_1, length);
+    memcpy(padded_2 + PADDING, codes_2, length);
+
+    widest = length > 1 ? sliding_window(length - 1) : 0;
+#ifdef HAVE_AVX2
+    if (use_avx2)
+        base_matches_avx2(padded_1, padded_2, widest, matches);
+    else
+#endif
+        base_matches(padded_1, padded_2, widest, matches);
+
+    for (offset = -widest; offset <= widest; offset++) {
+        if (matches[offset + widest]) {
+            runs[live] = matches[offset + widest];
+            offsets[live] = offset;
+            live++;
+        }
+    }
+
+    for (k = 1; k < length && live; k++) {
+        Py_ssize_t window = sliding_window(k);
+        uint64_t window_matches = 0;
+        if (k > 1) {
+            Py_ssize_t kept = 0;
+            for (t = 0; t < live; t++) {
+                uint64_t run = runs[t] & runs[t] >> 1; /* extend runs by one base */
+                if (run) {
+                    runs[kept] = run;
+                    offsets[kept] = offsets[t];
+                    kept++;
+                }
+            }
+            live = kept;
+        }
+        for (t = 0; t < live; t++) {
+            if (offsets[t] >= -window && offsets[t] <= window)
+                window_matches |= runs[t];
+        }
+        score += popcount64(window_matches);
+    }
+
+    return score;
+}
+
+static PyObject *
+homology_score(PyObject *self, PyObject *args)
+{
+    Py_buffer codes_1, codes_2;
+    long score;
+
+    if (!PyArg_ParseTuple(args, "y*y*:homology_score", &codes_1, &codes_2))
+        return NULL;
+    if (codes_1.len != codes_2.len || codes_1.len > MAX_LENGTH) {
+        PyBuffer_Release(&codes_1);
+        PyBuffer_Release(&codes_2);
+        PyErr_SetString(PyExc_ValueError, "Strings should be equal in length and at most 64 bases.");
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    score = score_runs(codes_1.buf, codes_2.buf, codes_1.len);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&codes_1);
+    PyBuffer_Release(&codes_2);
+
+    return PyLong_FromLong(score);
+}
+
+static PyMethodDef score_methods[] = {
+    {"homology_score", homology_score, METH_VARARGS,
+     "Get summed homology score between two encoded strings of at most 64 bases."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef score_module = {
+    PyModuleDef_HEAD_INIT, "_score", "Compiled homology scoring kernel.", -1, score_methods
+};
+
+PyMODINIT_FUNC
+PyInit__score(void)
+{
+#ifdef HAVE_AVX2
+    __builtin_cpu_init();
+    use_avx2 = __builtin_cpu_supports("avx2");
+#endif
+    return PyModule_Create(&score_module);
+}
@@ -2,20 +2,70 @@
 
 """Evolutionary algorithm for finding pairs of non-homologous DNA strings."""
 
-from random import choice, randint, random
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache, partial
+from itertools import chain
+from math import log, log1p
+from multiprocessing.shared_memory import SharedMemory
+from operator import itemgetter
+from random import Random
 from statistics import mode
 
+try:
+    from _score import homology_score as compiled_homology_score # built with setup.py build_ext
+except ImportError:
+    compiled_homology_score = None # fall back to pure Python scoring
 
-def get_substrings(full_string: str, k: int) -> list[str]:
+base_codes = {"A": 0, "C": 1, "T": 2, "G": 3} # 2-bit codes for DNA bases
+code_table = bytes.maketrans("".join(base_codes).encode(), bytes(base_codes.values())) # ASCII to 2-bit code
+digit_table = bytes.maketrans(bytes(base_codes.values()), b"0123") # 2-bit code to base-4 digit
+base_table = bytes.maketrans(bytes(base_codes.values()), "".join(base_codes).encode()) # 2-bit code to ASCII
+code_bits = bytes(b % len(base_codes) for b in range(256)) # random byte to 2-bit code
+rng = Random() # shared random number generator
+terminator = re.compile(bytes([base_codes["T"]]*4)) # RNA polymerase III terminator
+shared_population = None # population buffer attached in worker processes
+
+
+def encode_string(full_string: str) -> bytes:
+    """
+    Encode a DNA string as bytes of 2-bit base codes.
+    """
+    codes = full_string.encode("ascii").translate(code_table)
+    if codes and max(codes) > 3:
+        raise ValueError("Strings should only contain DNA bases.")
+
+    return codes
+
+
+def decode_string(codes: bytes) -> str:
+    """
+    Decode bytes of 2-bit base codes as a DNA string.
+    """
+    full_string = codes.translate(base_table).decode("ascii")
+
+    return full_string
+
+
+def pack_string(codes: bytes) -> int:
     """
-    Get all substrings of a string with length k.
-    Returns a list in left-to-right order.
+    Pack bytes of 2-bit base codes into one integer, first base in the lowest bits.
     """
-    substrings = []
-    for i in range(len(full_string)-k+1):
-        substrings.append(full_string[i:i+k])
+    packed = int(codes[::-1].translate(digit_table), 4) if codes else 0 # parse as a base-4 number
 
-    return substrings
+    return packed
+
+
+@lru_cache(maxsize=None)
+def get_base_mask(length: int) -> int:
+    """
+    Get mask of the low bit of each base in a packed string of a given length.
+    """
+    mask = int("01"*length, 2) if length > 0 else 0
+
+    return mask
 
 
 def get_sliding_window(substring: str) -> int:
@@ -27,22 +77,94 @@ def get_sliding_window(substring: str) -> int:
     return window
 
 
-def score_substrings(substrings_1, substrings_2: list[str], sliding_window: int) -> int:
+@lru_cache(maxsize=None)
+def get_sliding_windows(length: int) -> tuple[int]:
     """
-    Score two lists of substrings by number of matches within a sliding window.
-    Input two equal length lists of substrings with equal length.
-    Output homology score between the lists.
+    Get sliding window sizes for every substring length k in [1, length).
+    Computed once per string length so fitness scoring only loops over integers.
     """
-    homology_score = 0
-    list_length = len(substrings_1)
+    windows = tuple(get_sliding_window("." * k) for k in range(1, length))
 
-    for i in range(list_length):
-        left_index = i - sliding_window if i >= sliding_window else 0
-        right_index = i + sliding_window + 1 if list_length - i > sliding_window else list_length
-        if substrings_1[i] in substrings_2[left_index: right_index]:
-            homology_score += 1
+    return windows
 
-    return homology_score
+
+@lru_cache(maxsize=None)
+def get_max_score(length: int) -> int:
+    """
+    Get maximum homology score between two strings of a given length.
+    Identical strings match at every one of the length-k+1 positions for each k.
+    """
+    max_score = length*(length + 1)//2 - 1 # sum of length-k+1 over k in [1, length)
+
+    return max_score
+
+
+@lru_cache(maxsize=None)
+def make_homology_scorer(length: int):
+    """
+    Generate a homology scorer specialized to strings of a given length.
+    The scorer sums number of common substrings within size-based sliding windows over all lengths.
+    A substring of length k at position i matches at offset d when the
+    strings agree on a run of k bases starting at i and i+d, so runs are
+    tracked as bit masks per offset and shortened by one base for each k.
+    Stops early once no offset has a run left, since every remaining
+    homology score is then zero.
+    The loop over substring lengths is unrolled with every shift, window and
+    base mask written in as a constant.
+    """
+    sliding_windows = get_sliding_windows(length)
+    widest = max(sliding_windows, default=0)
+    lines = [
+        f"def homology_score_{length}(codes_1, codes_2):",
+        "    packed_1 = pack_string(codes_1)",
+        "    packed_2 = pack_string(codes_2)",
+        "    runs = {}",
+    ]
+    for offset in range(-widest, widest + 1): # compare base i with base i+offset
+        if offset >= 0:
+            valid = get_base_mask(length - offset)
+            lines.append(f"    difference = packed_1 ^ packed_2 >> {2*offset}")
+        else:
+            valid = get_base_mask(length) ^ get_base_mask(-offset)
+            lines.append(f"    difference = packed_1 ^ packed_2 << {-2*offset}")
+        lines.append(f"    runs[{offset}] = ~(difference | difference >> 1) & {valid:#x}") # both bits of a base agree
+    lines.append("    score = 0")
+    for k, sliding_window in enumerate(sliding_windows, start=1):
+        if k > 1:
+            lines.append("    runs = {offset: run for offset, r in runs.items() if (run := r & r >> 2)}")
+            lines.append("    if not runs:")
+            lines.append("        return score")
+        lines.append("    matches = 0")
+        lines.append("    for offset, run in runs.items():")
+        lines.append(f"        if {-sliding_window} <= offset <= {sliding_window}:")
+        lines.append("            matches |= run")
+        lines.append("    score += matches.bit_count()")
+    lines.append("    return score")
+
+    namespace = {"pack_string": pack_string}
+    exec(compile("\n".join(lines), f"<homology_score_{length}>", "exec"), namespace)
+    scorer = namespace[f"homology_score_{length}"]
+
+    return scorer
+
+
+def score_codes(codes_1, codes_2: bytes) -> float:
+    """
+    Get transposition distance between two encoded strings of equal length.
+    Uses the compiled scoring kernel where it is built and the strings fit,
+    otherwise a Python scorer generated for the string length.
+    """
+    length = len(codes_1)
+    if length < 2:
+        raise ValueError("Strings should be at least 2 bases long.") # no substring length to score
+    if compiled_homology_score is not None and length <= 64:
+        score = compiled_homology_score(codes_1, codes_2)
+    else:
+        score = make_homology_scorer(length)(codes_1, codes_2)
+
+    fitness = score/get_max_score(length) # normalize by maximum distance score
+
+    return fitness
 
 
 def score_fitness(string_1, string_2: str) -> float:
@@ -53,166 +175,220 @@ def score_fitness(string_1, string_2: str) -> float:
     if len(string_1) != len(string_2):
         raise ValueError("Strings should be equal in length.")
 
-    length = len(string_1)
-    score = 0
-    max_score = 0
+    fitness = score_codes(encode_string(string_1), encode_string(string_2)) # compare k-mers as integers
 
-    for k in range(1, length):
-        substrings_1 = get_substrings(string_1, k)
-        substrings_2 = get_substrings(string_2, k)
-        sliding_window = get_sliding_window("." * k)
-        homology_score = score_substrings(substrings_1, substrings_2, sliding_window)
-        score += homology_score
-        # sum homology scores across all substrings
-        identity = ["." * k]*(length - k + 1)
-        max_score += score_substrings(identity, identity, sliding_window)
-        # maximum distance score
+    return fitness
 
-    fitness = score/max_score
+
+@lru_cache(maxsize=1 << 16)
+def score_pair(pair: bytes) -> float:
+    """
+    Get fitness of a pair of encoded strings stored back to back.
+    Module-level so it can be sent to worker processes.
+    Cached since unmutated pairs carry over between generations.
+    """
+    length = len(pair)//2
+    fitness = score_codes(pair[:length], pair[length:])
 
     return fitness
 
 
-def generate_string(length: int) -> str:
+def get_population_size(population: bytearray, string_length: int) -> int:
     """
-    Generate random string of some given length.
-    Select for strings without RNA polymerase III terminators.
+    Get number of string pairs in a population.
+    """
+    size = len(population)//(2*string_length)
+
+    return size
+
+
+def attach_population(name: str) -> None:
+    """
+    Attach a worker process to a shared population buffer of a given name.
+    """
+    global shared_population
+    shared_population = SharedMemory(name=name)
+
+
+def score_shared_pairs(indices: list[int], string_length: int) -> list[float]:
+    """
+    Get fitness of pairs at given indices of the shared population buffer.
+    Module-level so it can be sent to worker processes.
     """
-    new_bases = []
-    count = 0 # count number of consecutive T's
-    for x in range(length):
-        new_base = choice(bases)
-        if new_base == "T":
-            count += 1
-        if count == 4:
-            new_base = "C"
-            count = 0 # reset count
-        new_bases.append(new_base)
+    pair_length = 2*string_length
+    buffer = shared_population.buf
+    fitness = [score_pair(bytes(buffer[i*pair_length:(i + 1)*pair_length])) for i in indices]
 
-    new_string = "".join(new_bases)
+    return fitness
+
+
+def score_population(population: bytearray, string_length: int, pool: ProcessPoolExecutor = None, shared_memory: SharedMemory = None, workers: int = 1) -> list[float]:
+    """
+    Get fitness of every pair of strings in a population.
+    Spread scoring across a process pool if one is given, in chunks sized for its number of workers.
+    If its workers are attached to shared memory, the population is copied there
+    and only pair indices are sent to them.
+    """
+    pairs = [bytes(population[i:i + 2*string_length]) for i in range(0, len(population), 2*string_length)]
+    first_indices = {} # score repeated pairs once
+    for i, pair in enumerate(pairs):
+        first_indices.setdefault(pair, i)
+    unique_pairs = list(first_indices)
+    chunksize = max(1, len(unique_pairs)//(4*workers)) # few chunks per worker
+    if pool is None:
+        scores = map(score_pair, unique_pairs)
+    elif shared_memory is None:
+        scores = pool.map(score_pair, unique_pairs, chunksize=chunksize)
+    else:
+        shared_memory.buf[:len(population)] = population
+        indices = list(first_indices.values())
+        chunks = [indices[i:i + chunksize] for i in range(0, len(indices), chunksize)]
+        scores = chain.from_iterable(pool.map(partial(score_shared_pairs, string_length=string_length), chunks))
+    pair_fitness = dict(zip(unique_pairs, scores))
+    fitness = [pair_fitness[pair] for pair in pairs]
+
+    return fitness
+
+
+def generate_string(length: int) -> bytes:
+    """
+    Generate random encoded string of some given length.
+    Select for strings without RNA polymerase III terminators.
+    """
+    new_string = rng.getrandbits(8*length).to_bytes(length, "little").translate(code_bits) # draw all bases at once
+    new_string = remove_terminators(new_string, base_codes["C"])
 
     return new_string
 
 
-def generate_population(string_length, size: int) -> list[tuple]:
+def generate_population(string_length, size: int) -> bytearray:
     """
     Generate population of n pairs of random strings of a given length.
+    Pairs are stored back to back as 2-bit base codes in one byte array.
     """
-    population = []
-    for i in range(size):
-        new_strings = []
-        for x in range(2):
-            new_strings.append(generate_string(string_length)) # generate a new pair of strings
-        population.append(tuple(new_strings))
+    population = bytearray().join(generate_string(string_length) for x in range(2*size))
 
     return population
 
 
-def mutate_base(base: str) -> str:
+def mutate_base(base: int) -> int:
     """
-    Change one base to a different base.
+    Change one base code to a different base code.
     """
-    new_base = choice([b for b in bases if b != base])
+    new_base = (base + rng.randint(1, len(base_codes) - 1)) % len(base_codes)
 
     return new_base
 
 
-def mutate_string(original_string: str, rate: float) -> str:
+def get_mutation_sites(length: int, rate: float) -> list[int]:
     """
-    Mutate a string at a given rate (per base).
+    Get positions to mutate in a string of a given length at a given rate (per base).
+    Draws geometric gaps between mutations instead of one random number per base.
     """
-    if rate < 0 or rate > 1:
-        raise ValueError("Mutation rate must be in the range of 0 to 1.")
+    if rate == 0:
+        return []
+    elif rate == 1:
+        return list(range(length))
 
-    new_bases = []
-    count = 0 # count T's
-    for base in original_string:
-        new_base = base
-        if random() < rate:
-            new_base = mutate_base(base)
-        if new_base == "T":
-            count += 1
-        if count == 4:
-            new_base = "C"
-            count = 0 # reset count
-        new_bases.append(new_base)
-
-    new_string = "".join(new_bases)
+    log_miss = log1p(-rate) # stays nonzero for rates too small to change 1 - rate
+    sites = []
+    site = -1
+    while True:
+        gap = log(1 - rng.random())/log_miss # number of unmutated bases before next mutation
+        if site + 1 + gap >= length:
+            break # compare as float first since tiny rates can give an infinite gap
+        site += 1 + int(gap)
+        sites.append(site)
 
-    return new_string
+    return sites
 
 
-def remove_terminators(sequence: str) -> str:
+def mutate_strings(population: bytearray, string_length: int, rate: float) -> None:
     """
-    Remove terminator from a given sequence.
+    Mutate every string in a population in place at a given rate (per base).
+    Terminators are fixed as each mutation is made, so strings must start without any.
     """
-    count = 0
-    new_bases = []
-    for base in sequence:
-        if base == "T":
-            count += 1
-        if count == 4:
-            new_bases.append("A") # flip fourth T
-            count = 0 # reset count
-        else:
-            new_bases.append(base)
+    if rate < 0 or rate > 1:
+        raise ValueError("Mutation rate must be in the range of 0 to 1.")
+
+    for i in get_mutation_sites(len(population), rate):
+        population[i] = mutate_base(population[i])
+        if population[i] == base_codes["T"]:
+            remove_terminator_at(population, i, string_length, base_codes["C"])
 
-    new_sequence = "".join(new_bases)
+
+def remove_terminator_at(population: bytearray, site, string_length, flip: int) -> None:
+    """
+    Remove terminator made by a T at a given site of a population in place.
+    Flip the fourth T of the run of T's through the site, which has at most seven T's
+    when the rest of the string has no terminators.
+    """
+    start = site - site % string_length # first base of the string holding the site
+    end = start + string_length
+    left = site
+    while left > start and population[left - 1] == base_codes["T"]:
+        left -= 1
+    right = site + 1
+    while right < end and population[right] == base_codes["T"]:
+        right += 1
+    if right - left >= 4:
+        population[left + 3] = flip
+
+
+def remove_terminators(sequence: bytes, flip: int = base_codes["A"]) -> bytes:
+    """
+    Remove terminators from a given encoded sequence.
+    Flip the fourth T of each run of four consecutive T's to another base.
+    """
+    new_sequence = terminator.sub(terminator.pattern[:3] + bytes([flip]), sequence)
 
     return new_sequence
 
 
-def cross_strings(strings_1, strings_2: tuple[str]) -> list[tuple]:
+def cross_strings(population: bytearray, string_length, index_1, index_2: int) -> bytearray:
     """
     Cross two pairs of parent strings to generate two new pairs of child strings.
+    Children are returned back to back in population layout.
     """
-    child_strings_1 = (strings_1[0], strings_2[1])
-    child_strings_2 = (strings_1[1], strings_2[0])
-
-    children = [child_strings_1, child_strings_2]
+    offset_1 = 2*string_length*index_1
+    offset_2 = 2*string_length*index_2
+    children = bytearray().join((
+        population[offset_1:offset_1 + string_length], # first child pair
+        population[offset_2 + string_length:offset_2 + 2*string_length],
+        population[offset_1 + string_length:offset_1 + 2*string_length], # second child pair
+        population[offset_2:offset_2 + string_length],
+    ))
 
     return children
 
 
-def generate_new_strings(population: list[tuple], tournament_size: int, mutation_rate: float) -> list[tuple]:
+def generate_new_strings(population: bytearray, string_length, tournament_size: int, mutation_rate: float, pool: ProcessPoolExecutor = None, shared_memory: SharedMemory = None, workers: int = 1) -> bytearray:
     """
     Generate new string pairs from a given population of string pairs.
     Create new children based on tournaments of a given size between existing strings.
+    Fitness is scored in parallel if a process pool is given, as in score_population.
     """
-    fitness = []
-    for strings in population:
-        new_score = score_fitness(strings[0], strings[1])
-        fitness.append(new_score) # build fitness landscape for strings
+    size = get_population_size(population, string_length)
+    fitness = score_population(population, string_length, pool, shared_memory, workers) # build fitness landscape for strings
 
+    draws = rng.choices(range(size), k=size*tournament_size) # potential suitors for every tournament at once
     suitors = [] # suitors for each string in current population based on fitness
-    for i, strings in enumerate(population):
-        best_suitor = strings
-        for j in range(tournament_size):
-            suitor = randint(0, len(population)-1) # index of potential suitor strings
-            if fitness[suitor] < fitness[i]:
-                best_suitor = population[suitor]
-        suitors.append(best_suitor)
-
-    selection = []
-    for x in range(len(population)//2):
-        new_selection = randint(0, len(population)-1)
-        selection.append(new_selection) # select indexes of strings to mate
-
-    new_generation = []
-    for i in selection:
-        children = cross_strings(population[i], suitors[i])
-        mutated_children = []
-        for child in children:
-            mutant_child = tuple(mutate_string(c, mutation_rate) for c in child)
-            mutated_children.append(mutant_child) # mutate children at specified rate
-        new_generation.extend(mutated_children)
+    for i in range(size):
+        best_suitor = min(draws[i*tournament_size:(i + 1)*tournament_size], key=fitness.__getitem__, default=i)
+        suitors.append(best_suitor if fitness[best_suitor] < fitness[i] else i)
+
+    selection = rng.choices(range(size), k=size//2) # select indexes of strings to mate
+
+    new_generation = bytearray().join(cross_strings(population, string_length, i, suitors[i]) for i in selection)
+    mutate_strings(new_generation, string_length, mutation_rate) # mutate children at specified rate
 
     return new_generation
 
 
-def evolve_strings(population_size, string_length, generations, tournament_size:  int, mutation_rate: float) -> list[tuple]:
+def evolve_strings(population_size, string_length, generations, tournament_size:  int, mutation_rate: float, workers: int = None) -> list[tuple]:
     """
     Evolve pairs of strings over a given number of generations and tournament size.
+    Fitness is scored across a number of worker processes (default one per CPU).
     """
     if tournament_size >= population_size:
         raise ValueError("Tournament size must be less than population size.")
@@ -221,36 +397,74 @@ def evolve_strings(population_size, string_length, generations, tournament_size:
     print(f"Tournament size at {tournament_size} and mutation rate at {mutation_rate} per base ...")
     population = generate_population(string_length, population_size)
 
-    count = 0
-    for i in range(generations):
-        print(f"Evolving generation {i + 1} ...")
-        if len(population) == 0:
-            break
-        elif tournament_size >= len(population):
-            break
-        else:
-            population = generate_new_strings(population, tournament_size, mutation_rate)
-            count += 1
-
-    fitness = [] # final fitness landscape
-    for strings in population:
-        score = score_fitness(strings[0], strings[1])
-        fitness.append(score)
+    workers = workers or os.cpu_count() or 1
+    with ExitStack() as stack:
+        pool = shared_memory = None
+        if workers > 1: # reuse workers and population buffer across generations
+            shared_memory = SharedMemory(create=True, size=max(1, len(population))) # population never grows
+            stack.callback(shared_memory.unlink)
+            stack.callback(shared_memory.close)
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=attach_population, initargs=(shared_memory.name,)))
+        count = 0
+        for i in range(generations):
+            print(f"Evolving generation {i + 1} ...")
+            size = get_population_size(population, string_length)
+            if size == 0:
+                break
+            elif tournament_size >= size:
+                break
+            else:
+                population = generate_new_strings(population, string_length, tournament_size, mutation_rate, pool, shared_memory, workers)
+                count += 1
+
+        fitness = score_population(population, string_length, pool, shared_memory, workers) # final fitness landscape
 
     evolved_strings = []
-    for i, strings in enumerate(population):
-        evolved_strings.append((fitness[i], strings[0], strings[1]))
+    for i, offset in enumerate(range(0, len(population), 2*string_length)):
+        strings = (population[offset:offset + string_length], population[offset + string_length:offset + 2*string_length])
+        evolved_strings.append((fitness[i], decode_string(strings[0]), decode_string(strings[1])))
         # evolved strings with fitness scores
 
-    evolved_strings.sort(key = lambda s: s[0]) # sort strings based on fitness
+    evolved_strings.sort(key=itemgetter(0)) # sort strings based on fitness
 
     print(f"Final iteration at generation {count}.")
 
     return evolved_strings
 
 
+def evolve_island(island_seed: int, **kwargs) -> list[tuple]:
+    """
+    Evolve one island population from its own random seed.
+    Module-level so it can be sent to worker processes.
+    """
+    rng.seed(island_seed)
+    evolved_strings = evolve_strings(**kwargs, workers=1) # islands already run in parallel
+
+    return evolved_strings
+
+
+def evolve_islands(n_islands: int, **kwargs) -> list[tuple]:
+    """
+    Evolve independent populations of string pairs in parallel and merge them.
+    Takes the same keyword arguments as evolve_strings, applied to every island,
+    except workers since each island scores its own population serially.
+    """
+    if n_islands < 1:
+        raise ValueError("Number of islands must be at least 1.")
+    if "workers" in kwargs:
+        raise ValueError("Workers cannot be set for islands, which already run in parallel.")
+
+    island_seeds = [rng.getrandbits(64) for x in range(n_islands)] # distinct random stream per island
+    with ProcessPoolExecutor(max_workers=n_islands) as pool:
+        islands = pool.map(partial(evolve_island, **kwargs), island_seeds)
+        evolved_strings = [strings for island in islands for strings in island]
+
+    evolved_strings.sort(key=itemgetter(0)) # sort strings from all islands on fitness
+
+    return evolved_strings
+
+
 if __name__ == "__main__":
-    bases = ["A", "C", "T", "G"]  # DNA bases
     print("###########################################")
     print("Evolve pairs of non-homologous DNA strings.")
     print("###########################################")
@@ -0,0 +1,12 @@
+# setup.py
+
+"""Build the optional compiled scoring kernel with: python setup.py build_ext --inplace"""
+
+from setuptools import Extension, setup
+
+
+setup(
+    name="DNA-evolver",
+    py_modules=["evolve_strings"],
+    ext_modules=[Extension("_score", ["_score.c"])],
+)